@@ -22,12 +22,21 @@ Note: This code is a production-ready starting point. You can extend it with a w
 """
 
 import os
+import asyncio
 import sqlite3
+import codecs
 import csv
 import io
 import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date
-from apscheduler.schedulers.background import BackgroundScheduler
+from functools import lru_cache, wraps
+from itertools import count
+from pathlib import Path
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import (
@@ -46,14 +55,101 @@ if not TOKEN:
     raise RuntimeError("Set TELEGRAM_TOKEN environment variable with your bot token")
 
 DB_PATH = os.environ.get("ATTENDANCE_DB", "attendance_bot.db")
+# Attendance clicks are queued and written in batches: one transaction per
+# ATTENDANCE_BATCH_SIZE records or per ATTENDANCE_FLUSH_INTERVAL seconds.
+ATTENDANCE_BATCH_SIZE = 500
+ATTENDANCE_FLUSH_INTERVAL = 0.1
+# a batch that fails to write is retried, backing off from 1s up to 30s
+ATTENDANCE_RETRY_DELAY = 1
+ATTENDANCE_RETRY_MAX_DELAY = 30
+# seconds a cached group/member/session lookup is trusted; bounds how long an
+# edit made directly in the database (e.g. setting an admin) goes unnoticed
+LOOKUP_CACHE_TTL = 30
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # -------- Database helpers --------
 
+# Statements run on every handler/button press. Kept as module constants so
+# each connection's statement cache (cached_statements) reuses the prepared
+# statement instead of parsing the SQL again.
+SQL_GROUP_BY_CHAT = "SELECT id, group_name FROM groups WHERE chat_id = ?"
+SQL_MEMBER_BY_TELEGRAM = "SELECT id, full_name, role FROM members WHERE group_id = ? AND telegram_id = ? AND active = 1"
+# everything a button press needs in one statement: the member being marked,
+# the clicking user's role in the session's group and whether it is closed
+SQL_CALLBACK_CONTEXT = (
+    "SELECT m.telegram_id, m.full_name, inv.role, s.closed FROM members m "
+    "CROSS JOIN attendance_sessions s "
+    "LEFT JOIN members inv ON inv.group_id = s.group_id AND inv.telegram_id = ? AND inv.active = 1 "
+    "WHERE m.id = ? AND s.id = ?"
+)
+SQL_UPSERT_ATTENDANCE = (
+    "INSERT INTO attendance_records (session_id, member_id, status, timestamp) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(session_id, member_id) DO UPDATE SET status = excluded.status, timestamp = excluded.timestamp"
+)
+STATEMENT_CACHE_SIZE = 512
+
+
+class DBPool:
+    """One lock-guarded write connection plus a read-only connection per thread.
+
+    With WAL enabled readers work on their own snapshot, so SELECTs from
+    different threads never wait on each other or on the writer.
+    """
+
+    def __init__(self, path):
+        self._read_uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self._write_conn = sqlite3.connect(
+            path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        # page_size only applies to a new database, so it must come first
+        self._write_conn.execute("PRAGMA page_size=8192")
+        # WAL lets readers run alongside the writer and only fsyncs on checkpoints
+        self._write_conn.execute("PRAGMA journal_mode=WAL")
+        self._configure(self._write_conn)
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def _configure(conn):
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        # read pages straight from the OS page cache instead of copying them
+        conn.execute("PRAGMA mmap_size=268435456")
+
+    def get_read_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self._read_uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE
+            )
+            self._configure(conn)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def write(self):
+        # one transaction on the shared write connection, committed on exit
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    pool = DBPool(DB_PATH)
+    with pool.write() as conn:
+        create_tables(conn)
+    return pool
+
+
+def create_tables(conn):
     cur = conn.cursor()
     # groups table (one row per chat/group)
     cur.execute(
@@ -125,140 +221,379 @@ def init_db():
         """
     )
 
-    conn.commit()
-    return conn
-
-
-conn = init_db()
+    # indexes for the hot lookups: latest session per group, session records
+    # joined for reports/exports, and the sorted active member list
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sessions_group_id ON attendance_sessions (group_id, id DESC)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_records_session ON attendance_records (session_id, member_id, status, timestamp)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_members_active ON members (group_id, active, full_name, telegram_id, role)"
+    )
 
 
+pool = init_db()
+
+
+def ttl_cache(maxsize, ttl=LOOKUP_CACHE_TTL):
+    # like lru_cache, but entries also expire after ttl seconds. Writes run in
+    # worker threads and clear the cache after committing, so a lookup that was
+    # already running may have read the old row: cache_clear() bumps a
+    # generation and such a lookup returns its result without storing it.
+    def decorator(fn):
+        cache = OrderedDict()  # args -> (expiry, value)
+        lock = threading.Lock()
+        generation = 0
+
+        @wraps(fn)
+        def wrapper(*args):
+            now = time.monotonic()
+            with lock:
+                entry = cache.get(args)
+                if entry and entry[0] > now:
+                    cache.move_to_end(args)
+                    return entry[1]
+                started = generation
+            value = fn(*args)
+            with lock:
+                if generation != started:
+                    return value
+                cache[args] = (now + ttl, value)
+                cache.move_to_end(args)
+                if len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return value
+
+        def cache_clear():
+            nonlocal generation
+            with lock:
+                generation += 1
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
+# Group, member and session lookups are cached for LOOKUP_CACHE_TTL seconds;
+# writes made by the bot clear the matching cache right away. The attendance
+# keyboard is keyed by members_version, which invalidate_members() bumps
+# (next() on a count is atomic, so writers in worker threads never hand out
+# the same version twice).
+_members_versions = count(1)
+members_version = 0
+
+
+def invalidate_members():
+    global members_version
+    members_version = next(_members_versions)
+    get_member_by_telegram.cache_clear()
+    get_callback_context.cache_clear()
+
+
+@ttl_cache(maxsize=1024)
 def get_group_by_chat(chat_id):
-    cur = conn.cursor()
-    cur.execute("SELECT id, group_name FROM groups WHERE chat_id = ?", (chat_id,))
-    return cur.fetchone()  # (id, group_name) or None
+    # (id, group_name) or None
+    return pool.get_read_conn().execute(SQL_GROUP_BY_CHAT, (chat_id,)).fetchone()
 
 
 def ensure_group(chat_id, group_name=None):
     g = get_group_by_chat(chat_id)
-    cur = conn.cursor()
     if g:
         return g[0]  # group_id
     created_at = datetime.utcnow().isoformat()
-    cur.execute(
-        "INSERT OR IGNORE INTO groups (chat_id, group_name, created_at) VALUES (?, ?, ?)",
-        (chat_id, group_name or str(chat_id), created_at),
-    )
-    conn.commit()
+    with pool.write() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO groups (chat_id, group_name, created_at) VALUES (?, ?, ?)",
+            (chat_id, group_name or str(chat_id), created_at),
+        )
+    get_group_by_chat.cache_clear()
     return get_group_by_chat(chat_id)[0]
 
 
 def add_member_db(group_id, telegram_id, full_name, role="member"):
-    cur = conn.cursor()
-    try:
-        cur.execute(
-            "INSERT INTO members (group_id, telegram_id, full_name, role) VALUES (?, ?, ?, ?)",
+    # insert, or update name/role and reactivate if already registered
+    with pool.write() as conn:
+        conn.execute(
+            "INSERT INTO members (group_id, telegram_id, full_name, role) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(group_id, telegram_id) DO UPDATE SET full_name = excluded.full_name, role = excluded.role, active = 1",
             (group_id, telegram_id, full_name, role),
         )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        # already exists - update name/role
-        cur.execute(
-            "UPDATE members SET full_name = ?, role = ?, active = 1 WHERE group_id = ? AND telegram_id = ?",
-            (full_name, role, group_id, telegram_id),
-        )
-        conn.commit()
+    invalidate_members()
 
 
+@ttl_cache(maxsize=4096)
 def get_member_by_telegram(group_id, telegram_id):
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, full_name, role FROM members WHERE group_id = ? AND telegram_id = ? AND active = 1",
-        (group_id, telegram_id),
+    # (id, full_name, role) or None
+    return (
+        pool.get_read_conn()
+        .execute(SQL_MEMBER_BY_TELEGRAM, (group_id, telegram_id))
+        .fetchone()
     )
-    return cur.fetchone()  # (id, full_name, role)
 
 
 def get_all_members(group_id):
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, telegram_id, full_name, role FROM members WHERE group_id = ? AND active = 1 ORDER BY full_name",
-        (group_id,),
+    return (
+        pool.get_read_conn()
+        .execute(
+            "SELECT id, telegram_id, full_name, role FROM members WHERE group_id = ? AND active = 1 ORDER BY full_name",
+            (group_id,),
+        )
+        .fetchall()
     )
-    return cur.fetchall()
 
 
 def create_session_db(group_id, session_title, created_by):
-    cur = conn.cursor()
     session_date = date.today().isoformat()
     created_at = datetime.utcnow().isoformat()
-    cur.execute(
-        "INSERT INTO attendance_sessions (group_id, session_date, session_title, created_by, created_at) VALUES (?, ?, ?, ?, ?)",
-        (group_id, session_date, session_title, created_by, created_at),
-    )
-    conn.commit()
+    with pool.write() as conn:
+        cur = conn.execute(
+            "INSERT INTO attendance_sessions (group_id, session_date, session_title, created_by, created_at) VALUES (?, ?, ?, ?, ?)",
+            (group_id, session_date, session_title, created_by, created_at),
+        )
+    get_callback_context.cache_clear()
     return cur.lastrowid
 
 
-def set_session_message_id(session_id, message_id):
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE attendance_sessions SET message_id = ? WHERE id = ?",
-        (message_id, session_id),
+@ttl_cache(maxsize=4096)
+def get_callback_context(session_id, member_id, invoker_tg_id):
+    # (member telegram_id, member full_name, invoker role or None, closed) or None
+    return (
+        pool.get_read_conn()
+        .execute(SQL_CALLBACK_CONTEXT, (invoker_tg_id, member_id, session_id))
+        .fetchone()
     )
-    conn.commit()
+
+
+def close_session_db(session_id):
+    with pool.write() as conn:
+        conn.execute(
+            "UPDATE attendance_sessions SET closed = 1 WHERE id = ?", (session_id,)
+        )
+    get_callback_context.cache_clear()
+
+
+def promote_member_db(group_id, telegram_id):
+    with pool.write() as conn:
+        conn.execute(
+            "UPDATE members SET role = 'admin' WHERE group_id = ? AND telegram_id = ?",
+            (group_id, telegram_id),
+        )
+    invalidate_members()
+
+
+def save_scheduled_job_db(group_chat_id, cron_expr, job_name):
+    # persist job info
+    with pool.write() as conn:
+        conn.execute(
+            "INSERT INTO scheduled_jobs (group_id, cron_expr, job_name, created_at) VALUES ((SELECT id FROM groups WHERE chat_id = ?), ?, ?, ?)",
+            (group_chat_id, str(cron_expr), job_name, datetime.utcnow().isoformat()),
+        )
+
+
+def set_session_message_id(session_id, message_id):
+    with pool.write() as conn:
+        conn.execute(
+            "UPDATE attendance_sessions SET message_id = ? WHERE id = ?",
+            (message_id, session_id),
+        )
+
+
+# queue of (session_id, member_id, status, timestamp) drained by attendance_writer
+attendance_queue = None
 
 
 def record_attendance(session_id, member_id, status):
-    cur = conn.cursor()
     timestamp = datetime.utcnow().isoformat()
-    try:
-        cur.execute(
-            "INSERT INTO attendance_records (session_id, member_id, status, timestamp) VALUES (?, ?, ?, ?)",
-            (session_id, member_id, status, timestamp),
-        )
-    except sqlite3.IntegrityError:
-        # update
-        cur.execute(
-            "UPDATE attendance_records SET status = ?, timestamp = ? WHERE session_id = ? AND member_id = ?",
-            (status, timestamp, session_id, member_id),
+    attendance_queue.put_nowait((session_id, member_id, status, timestamp))
+
+
+def flush_attendance(batch):
+    # write a batch of queued records in a single transaction
+    with pool.write() as conn:
+        conn.executemany(SQL_UPSERT_ATTENDANCE, batch)
+
+
+async def attendance_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await attendance_queue.get()]
+        deadline = loop.time() + ATTENDANCE_FLUSH_INTERVAL
+        try:
+            while len(batch) < ATTENDANCE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(attendance_queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            # retry the same batch until it is written; moving on (or requeueing
+            # it behind newer clicks) could overwrite a later status
+            delay = ATTENDANCE_RETRY_DELAY
+            while True:
+                try:
+                    await _db_run(flush_attendance, batch)
+                    break
+                except Exception:
+                    logger.exception(
+                        "Failed to write %d attendance records, retrying in %ss",
+                        len(batch),
+                        delay,
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, ATTENDANCE_RETRY_MAX_DELAY)
+        except asyncio.CancelledError:
+            # shutting down: write the records already taken off the queue
+            try:
+                flush_attendance(batch)
+            except sqlite3.Error:
+                logger.exception("Lost %d attendance records on shutdown", len(batch))
+            raise
+
+
+def drain_attendance_queue():
+    # flush whatever is still queued (used on shutdown)
+    batch = []
+    while not attendance_queue.empty():
+        batch.append(attendance_queue.get_nowait())
+    if batch:
+        flush_attendance(batch)
+
+
+def get_session_summary(session_id):
+    # {status: count}, counted by SQLite instead of fetching every record
+    rows = (
+        pool.get_read_conn()
+        .execute(
+            "SELECT status, COUNT(*) FROM attendance_records WHERE session_id = ? GROUP BY status",
+            (session_id,),
         )
-    conn.commit()
+        .fetchall()
+    )
+    return dict(rows)
 
 
-def get_session_records(session_id):
-    cur = conn.cursor()
+def export_session_csv(session_id):
+    cur = pool.get_read_conn().cursor()
+    cur.arraysize = 1000
     cur.execute(
         "SELECT m.full_name, r.status, r.timestamp FROM attendance_records r JOIN members m ON m.id = r.member_id WHERE r.session_id = ? ORDER BY m.full_name",
         (session_id,),
     )
-    return cur.fetchall()
+    # rows go from the cursor straight into one buffer (no fetchall list or
+    # str-to-bytes copy); PTB's InputFile reads any file object fully, so
+    # spilling to disk first would not save memory
+    output = io.BytesIO()
+    writer = csv.writer(codecs.getwriter("utf-8")(output))
+    writer.writerow(["Full Name", "Status", "Timestamp"])
+    writer.writerows(cur)
+    return output.getvalue()  # CSV bytes
+
+
+async def _db_run(fn, *args):
+    # run a blocking database helper in a worker thread so the event loop
+    # keeps serving other updates while SQLite waits on locks or fsync
+    return await asyncio.to_thread(fn, *args)
+
+
+# -------- Keyboards --------
+
+
+@ttl_cache(maxsize=256)
+def _keyboard_template(group_id, version):
+    # (full_name, member_id) per button row; version (members_version) is only
+    # part of the cache key, so a member change starts a fresh entry
+    return tuple(
+        (full_name, m_id) for m_id, _, full_name, _ in get_all_members(group_id)
+    )
+
+
+def build_attendance_keyboard(group_id, session_id):
+    # one button per member; clicking a name asks the member to choose a status
+    template = _keyboard_template(group_id, members_version)
+    if not template:
+        return None
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    full_name, callback_data=f"choose:{session_id}:{m_id}"
+                )
+            ]
+            for full_name, m_id in template
+        ]
+    )
+
+
+# (label, status) for each row of the status picker shown after a name click
+STATUS_CHOICES = (("Present", "present"), ("Late", "late"), ("Absent", "absent"))
+
+
+@lru_cache(maxsize=1024)
+def build_status_keyboard(session_id, member_id):
+    # markups are immutable, so repeat clicks on a name reuse the same object
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    label, callback_data=f"mark:{session_id}:{member_id}:{status}"
+                )
+            ]
+            for label, status in STATUS_CHOICES
+        ]
+    )
 
 
 # -------- Scheduler --------
-scheduler = BackgroundScheduler()
-scheduler.start()
+# created in post_init so it runs on the bot's event loop
+scheduler = None
+# (day_of_week, hour, minute) -> chat ids; one cron job posts to all of them
+scheduled_chats = {}
 
 
-def schedule_attendance_job(group_chat_id, cron_expr, job_name, application):
+def schedule_attendance_job(group_chat_id, cron_expr):
     # cron_expr is a dict suitable for CronTrigger e.g. {'day_of_week':'sun','hour':9,'minute':0}
+    # build the trigger first: it raises ValueError on bad input before any
+    # state is changed
     trigger = CronTrigger(**cron_expr)
+    key = (
+        str(cron_expr["day_of_week"]).lower(),
+        cron_expr["hour"],
+        cron_expr["minute"],
+    )
+    job_id = "cron-{}-{}-{}".format(*key)
+    sched_job = scheduler.get_job(job_id)
+    if not sched_job:
+        sched_job = scheduler.add_job(
+            post_scheduled_batch, trigger, args=[key], id=job_id
+        )
+    chat_ids = scheduled_chats.setdefault(key, [])
+    if group_chat_id not in chat_ids:
+        chat_ids.append(group_chat_id)
+    return sched_job
 
-    def job_func():
-        # runs in background thread; need to use application.create_task to call async function
-        logger.info(f"Scheduler firing job {job_name} for chat {group_chat_id}")
-        application.create_task(post_scheduled_attendance(group_chat_id))
 
-    sched_job = scheduler.add_job(
-        job_func, trigger, id=f"job-{group_chat_id}-{job_name}"
+async def post_scheduled_batch(key):
+    # post to every chat scheduled at this time concurrently
+    chat_ids = list(scheduled_chats.get(key, ()))
+    logger.info(f"Scheduler firing {key} for chats {chat_ids}")
+    results = await asyncio.gather(
+        *(post_scheduled_attendance(chat_id) for chat_id in chat_ids),
+        return_exceptions=True,
     )
-    # persist job info
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO scheduled_jobs (group_id, cron_expr, job_name, created_at) VALUES ((SELECT id FROM groups WHERE chat_id = ?), ?, ?, ?)",
-        (group_chat_id, str(cron_expr), job_name, datetime.utcnow().isoformat()),
-    )
-    conn.commit()
-    return sched_job
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error(
+                "Scheduled attendance failed for chat %s",
+                chat_id,
+                exc_info=result,
+            )
 
 
 async def post_scheduled_attendance(chat_id: int):
@@ -275,34 +610,74 @@ async def post_scheduled_attendance(chat_id: int):
         logger.error("Application instance not set; cannot post scheduled attendance")
         return
     # default title
-    session_id = create_session_db(
-        group_id, f"Scheduled attendance {date.today().isoformat()}", None
+    session_id = await _db_run(
+        create_session_db,
+        group_id,
+        f"Scheduled attendance {date.today().isoformat()}",
+        None,
     )
-    members = get_all_members(group_id)
-    if not members:
+    reply_markup = build_attendance_keyboard(group_id, session_id)
+    if not reply_markup:
         await APP_INSTANCE.bot.send_message(
             chat_id=chat_id, text="No members registered yet for attendance."
         )
         return
-    keyboard = []
-    # Make a keyboard with a button per member (or grouped) -- for simplicity we provide Present/Absent/Late buttons once user clicks their row
-    # We'll post a message with instructions and list members so they can click their name (we'll create buttons with callback data including member_id and session_id)
-    for m in members:
-        m_id, tg_id, full_name, role = m
-        keyboard.append(
-            [InlineKeyboardButton(full_name, callback_data=f"mark:{session_id}:{m_id}")]
-        )
-    reply_markup = InlineKeyboardMarkup(keyboard)
     msg = await APP_INSTANCE.bot.send_message(
         chat_id=chat_id,
         text=f"Attendance time! Click your name to mark attendance for {date.today().isoformat()}\n(After clicking your name choose Present/Absent/Late)",
         reply_markup=reply_markup,
     )
-    set_session_message_id(session_id, msg.message_id)
+    await _db_run(set_session_message_id, session_id, msg.message_id)
 
 
 # APP_INSTANCE will be set in main()
 APP_INSTANCE = None
+# background task started in post_init
+ATTENDANCE_WRITER = None
+
+# -------- Telegram API caching --------
+
+
+def async_ttl_cache(ttl):
+    # cache an async function's result per positional args for ttl seconds
+    def decorator(fn):
+        cache = {}  # args -> (expiry, value)
+        locks = {}  # args -> asyncio.Lock; only callers for the same args wait
+
+        @wraps(fn)
+        async def wrapper(*args):
+            entry = cache.get(args)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            lock = locks.setdefault(args, asyncio.Lock())
+            async with lock:
+                # another caller may have refreshed it while we waited
+                now = time.monotonic()
+                entry = cache.get(args)
+                if entry and entry[0] > now:
+                    return entry[1]
+                value = await fn(*args)
+                # drop expired entries (and idle locks) so keys that are never
+                # asked for again don't pile up
+                for key in [k for k, (expiry, _) in cache.items() if expiry <= now]:
+                    del cache[key]
+                    idle = locks.get(key)
+                    if key != args and idle and not idle.locked():
+                        del locks[key]
+                cache[args] = (time.monotonic() + ttl, value)
+                return value
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+@async_ttl_cache(ttl=300)
+async def get_chat_admin_ids(chat_id):
+    admins = await APP_INSTANCE.bot.get_chat_administrators(chat_id)
+    return frozenset(admin.user.id for admin in admins)
+
 
 # -------- Command handlers (async) --------
 
@@ -342,11 +717,11 @@ async def end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Only admins can end a session.")
         return
 
-    cur = conn.cursor()
+    conn = pool.get_read_conn()
 
     # Parse session
     if context.args and context.args[0].lower() == "latest":
-        cur.execute(
+        cur = conn.execute(
             "SELECT id, message_id FROM attendance_sessions WHERE group_id = ? ORDER BY id DESC LIMIT 1",
             (group_id,),
         )
@@ -359,7 +734,7 @@ async def end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             await update.message.reply_text("Invalid session ID.")
             return
-        cur.execute(
+        cur = conn.execute(
             "SELECT id, message_id FROM attendance_sessions WHERE id = ? AND group_id = ?",
             (sid, group_id),
         )
@@ -372,8 +747,7 @@ async def end_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
     session_id, message_id = row
 
     # Mark as closed
-    cur.execute("UPDATE attendance_sessions SET closed = 1 WHERE id = ?", (session_id,))
-    conn.commit()
+    await _db_run(close_session_db, session_id)
 
     # Edit attendance message in group (optional)
     try:
@@ -393,10 +767,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     if chat.type in ("group", "supergroup"):
         # ensure group exists
-        group_id = ensure_group(chat.id, chat.title)
-        admins = await context.bot.get_chat_administrators(chat.id)
-        if user.id in [admin.user.id for admin in admins]:
-            add_member_db(group_id, user.id, user.full_name, role="admin")
+        group_id = await _db_run(ensure_group, chat.id, chat.title)
+        if user.id in await get_chat_admin_ids(chat.id):
+            await _db_run(add_member_db, group_id, user.id, user.full_name, "admin")
         # add the user as admin by default if they are group creator? We keep simple: user must /register to be member
         await update.message.reply_text(
             "Hello! I'm AttendanceBot. Members should register using /register <Full name>. Admins can add members with /add_member @username Full Name."
@@ -415,7 +788,7 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Please register from within a group chat where attendance is taken."
         )
         return
-    group_id = ensure_group(chat.id, chat.title)
+    group_id = await _db_run(ensure_group, chat.id, chat.title)
 
     # Check if already registered
     existing = get_member_by_telegram(group_id, user.id)
@@ -428,7 +801,7 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         # use Telegram name fallback
         full_name = user.full_name
-    add_member_db(group_id, user.id, full_name)
+    await _db_run(add_member_db, group_id, user.id, full_name)
     await update.message.reply_text(f"Registered {full_name} for attendance.")
 
 
@@ -479,7 +852,7 @@ async def add_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Couldn't parse telegram id. Example: /add_member 123456789 "
         )
         return
-    add_member_db(group_id, tg_id, full_name)
+    await _db_run(add_member_db, group_id, tg_id, full_name)
     await update.message.reply_text(f"Added {full_name} to the group.")
 
 
@@ -504,12 +877,7 @@ async def promote_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("Invalid id.")
         return
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE members SET role = 'admin' WHERE group_id = ? AND telegram_id = ?",
-        (group_id, tg_id),
-    )
-    conn.commit()
+    await _db_run(promote_member_db, group_id, tg_id)
     await update.message.reply_text("Promoted user to admin.")
 
 
@@ -532,128 +900,69 @@ async def attendance_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if context.args
         else f"Attendance {date.today().isoformat()}"
     )
-    session_id = create_session_db(group_id, title, user.id)
-    members = get_all_members(group_id)
-    if not members:
+    session_id = await _db_run(create_session_db, group_id, title, user.id)
+    reply_markup = build_attendance_keyboard(group_id, session_id)
+    if not reply_markup:
         await update.message.reply_text(
             "No members registered yet. Members should run /register or admins can add them."
         )
         return
-    keyboard = []
-    for m in members:
-        m_id, tg_id, full_name, role = m
-        # clicking a name will ask the user to choose status
-        keyboard.append(
-            [
-                InlineKeyboardButton(
-                    full_name, callback_data=f"choose:{session_id}:{m_id}"
-                )
-            ]
-        )
-    reply_markup = InlineKeyboardMarkup(keyboard)
     msg = await update.message.reply_text(
         f"Attendance started: {title}\nClick your name to mark attendance.",
         reply_markup=reply_markup,
     )
-    set_session_message_id(session_id, msg.message_id)
+    await _db_run(set_session_message_id, session_id, msg.message_id)
 
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     data = query.data
     user = update.effective_user
+    # every path answers the query exactly once; Telegram rejects a second answer
     # data formats: choose:session:member , mark:session:member:status
-    parts = data.split(":")
-    if parts[0] == "choose":
-        _, session_id, member_id = parts
+    if data.startswith("choose:"):
+        session_id, member_id = data[7:].split(":", 1)
+        session_id, member_id = int(session_id), int(member_id)
         # Only allow the real Telegram user who matches member's telegram_id to mark themselves, or allow admins
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT telegram_id, full_name FROM members WHERE id = ?", (member_id,)
-        )
-        row = cur.fetchone()
+        row = get_callback_context(session_id, member_id, user.id)
         if not row:
+            await query.answer()
             await query.edit_message_text("Member not found (maybe removed).")
             return
-        member_tg_id, full_name = row
+        member_tg_id, full_name, invoker_role, _ = row
         # if the clicking user is not the member and not an admin, deny
-        group_id = (
-            conn.cursor()
-            .execute(
-                "SELECT group_id FROM attendance_sessions WHERE id = ?", (session_id,)
-            )
-            .fetchone()[0]
-        )
-        invoker = get_member_by_telegram(group_id, user.id)
-        if user.id != member_tg_id and (not invoker or invoker[2] != "admin"):
+        if user.id != member_tg_id and invoker_role != "admin":
             await query.answer("You cannot mark for another member.", show_alert=True)
             return
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "Present", callback_data=f"mark:{session_id}:{member_id}:present"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Late", callback_data=f"mark:{session_id}:{member_id}:late"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Absent", callback_data=f"mark:{session_id}:{member_id}:absent"
-                )
-            ],
-        ]
+        await query.answer()
         await query.message.reply_text(
             f"{full_name} — choose your attendance status:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-        )
-
-    elif parts[0] == "mark":
-        # mark:session:member:status
-        _, session_id, member_id, status = parts
-
-        curcheck = conn.cursor()
-        curcheck.execute(
-            "SELECT closed FROM attendance_sessions WHERE id = ?", (session_id,)
+            reply_markup=build_status_keyboard(session_id, member_id),
         )
-        crow = curcheck.fetchone()
-        if crow and crow[0] == 1:
-            await query.answer("This session has already been closed.", show_alert=True)
-            return
 
+    elif data.startswith("mark:"):
         # mark:session:member:status
-        _, session_id, member_id, status = parts
+        session_id, member_id, status = data[5:].split(":", 2)
+        session_id, member_id = int(session_id), int(member_id)
 
         # verify
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT telegram_id, full_name FROM members WHERE id = ?", (member_id,)
-        )
-        row = cur.fetchone()
+        row = get_callback_context(session_id, member_id, user.id)
         if not row:
             await query.answer("Member not found", show_alert=True)
             return
-        member_tg_id, full_name = row
-        group_id = (
-            conn.cursor()
-            .execute(
-                "SELECT group_id FROM attendance_sessions WHERE id = ?", (session_id,)
-            )
-            .fetchone()[0]
-        )
-        invoker = get_member_by_telegram(group_id, user.id)
-        if user.id != member_tg_id and (not invoker or invoker[2] != "admin"):
+        member_tg_id, full_name, invoker_role, closed = row
+        if closed == 1:
+            await query.answer("This session has already been closed.", show_alert=True)
+            return
+        if user.id != member_tg_id and invoker_role != "admin":
             await query.answer("You cannot mark for another member.", show_alert=True)
             return
         record_attendance(session_id, member_id, status)
-        await query.answer(f"Marked {full_name} as {status}")
-        # Optionally edit message or reply
-        await query.message.reply_text(
-            f"{full_name} marked as {status} by {user.full_name}"
-        )
+        # confirm with a toast rather than posting a new message per click
+        await query.answer(f"{full_name} marked as {status}")
+
+    else:
+        await query.answer()
 
 
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -667,16 +976,16 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Group not registered.")
         return
     group_id = group[0]
-    cur = conn.cursor()
+    conn = pool.get_read_conn()
     if context.args and context.args[0].lower() == "latest":
-        cur.execute(
+        cur = conn.execute(
             "SELECT id, session_title, session_date FROM attendance_sessions WHERE group_id = ? ORDER BY id DESC LIMIT 1",
             (group_id,),
         )
     elif context.args:
         try:
             sid = int(context.args[0])
-            cur.execute(
+            cur = conn.execute(
                 "SELECT id, session_title, session_date FROM attendance_sessions WHERE id = ? AND group_id = ?",
                 (sid, group_id),
             )
@@ -691,11 +1000,7 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Session not found.")
         return
     session_id, title, session_date = row
-    records = get_session_records(session_id)
-    summary = {}
-    for name, status, ts in records:
-        summary.setdefault(status, 0)
-        summary[status] += 1
+    summary = get_session_summary(session_id)
     text = f"Report for {title} (id={session_id}, date={session_date})\n"
     text += "\n".join([f"{k}: {v}" for k, v in summary.items()]) or "No records yet"
     await update.message.reply_text(text)
@@ -712,16 +1017,16 @@ async def export_csv_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Group not registered.")
         return
     group_id = group[0]
-    cur = conn.cursor()
+    conn = pool.get_read_conn()
     if context.args and context.args[0].lower() == "latest":
-        cur.execute(
+        cur = conn.execute(
             "SELECT id, session_title, session_date FROM attendance_sessions WHERE group_id = ? ORDER BY id DESC LIMIT 1",
             (group_id,),
         )
     elif context.args:
         try:
             sid = int(context.args[0])
-            cur.execute(
+            cur = conn.execute(
                 "SELECT id, session_title, session_date FROM attendance_sessions WHERE id = ? AND group_id = ?",
                 (sid, group_id),
             )
@@ -736,25 +1041,11 @@ async def export_csv_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Session not found.")
         return
     session_id, title, session_date = row
-    records = (
-        conn.cursor()
-        .execute(
-            "SELECT m.full_name, r.status, r.timestamp FROM attendance_records r JOIN members m ON m.id = r.member_id WHERE r.session_id = ? ORDER BY m.full_name",
-            (session_id,),
-        )
-        .fetchall()
+    # query, CSV writing and spool I/O all happen off the event loop
+    content = await _db_run(export_session_csv, session_id)
+    await update.message.reply_document(
+        document=InputFile(content, filename=f"attendance_session_{session_id}.csv")
     )
-    # create CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Full Name", "Status", "Timestamp"])
-    for r in records:
-        writer.writerow(r)
-    output.seek(0)
-    bio = io.BytesIO(output.read().encode("utf-8"))
-    bio.name = f"attendance_session_{session_id}.csv"
-    bio.seek(0)
-    await update.message.reply_document(document=InputFile(bio, filename=bio.name))
 
 
 async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -787,7 +1078,14 @@ async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     job_name = context.args[3]
     cron_expr = {"day_of_week": day_of_week, "hour": hour, "minute": minute}
-    schedule_attendance_job(chat.id, cron_expr, job_name, APP_INSTANCE)
+    try:
+        schedule_attendance_job(chat.id, cron_expr)
+    except ValueError:
+        await update.message.reply_text(
+            "Invalid schedule. Usage: /schedule <day_of_week> <hour> <minute> <job_name>\nExample: /schedule sun 9 0 sunday_service"
+        )
+        return
+    await _db_run(save_scheduled_job_db, chat.id, cron_expr, job_name)
     await update.message.reply_text(
         f"Scheduled job {job_name} on {day_of_week} at {hour}:{minute:02d}"
     )
@@ -812,16 +1110,35 @@ def register_handlers(app):
 
 async def post_init(application):
     # Called after app starts
-    global APP_INSTANCE
+    global APP_INSTANCE, attendance_queue, ATTENDANCE_WRITER, scheduler
     APP_INSTANCE = application
+    attendance_queue = asyncio.Queue()
+    ATTENDANCE_WRITER = asyncio.create_task(attendance_writer())
+    scheduler = AsyncIOScheduler()
+    scheduler.start()
     logger.info("Attendance bot started and ready")
 
 
+async def post_shutdown(application):
+    # stop the scheduler and the batch writer, persist anything still queued
+    if scheduler:
+        scheduler.shutdown(wait=False)
+    if ATTENDANCE_WRITER:
+        ATTENDANCE_WRITER.cancel()
+        try:
+            await ATTENDANCE_WRITER
+        except asyncio.CancelledError:
+            pass
+    if attendance_queue:
+        drain_attendance_queue()
+
+
 def main():
     application = (
         ApplicationBuilder()
         .token(TOKEN)
         .post_init(post_init)  # This is now correct
+        .post_shutdown(post_shutdown)
         .build()
     )
     register_handlers(application)